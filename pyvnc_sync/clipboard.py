@@ -0,0 +1,107 @@
+import struct
+import zlib
+
+# Extended Clipboard pseudo-encoding, 0xC0A1E5CE as a signed 32 bit int
+EXTENDED_CLIPBOARD_ENCODING = -1063131698
+
+CLIENT_CUT_TEXT = "!BxxxL"
+EXTENDED_CUT_TEXT = "!Bxxxl" # negative length marks an extended clipboard message
+FLAGS = "!L"
+
+# formats, the low 16 bits of the flags
+FORMAT_TEXT = 1 << 0
+FORMAT_RTF = 1 << 1
+FORMAT_HTML = 1 << 2
+FORMAT_DIB = 1 << 3
+FORMAT_FILES = 1 << 4
+FORMAT_MASK = 0xFFFF
+
+# actions, the high 8 bits of the flags
+ACTION_CAPS = 1 << 24
+ACTION_REQUEST = 1 << 25
+ACTION_PEEK = 1 << 26
+ACTION_NOTIFY = 1 << 27
+ACTION_PROVIDE = 1 << 28
+
+# the largest text we'll accept from the server without having to ask
+DEFAULT_MAX_TEXT_SIZE = 20 * 1024 * 1024
+
+
+def _formats(flags):
+    """
+    Yields the individual format bits set in flags, lowest first, which is the
+    order their sizes and payloads appear in on the wire.
+    """
+    for bit in range(16):
+        if flags & (1 << bit):
+            yield 1 << bit
+
+
+def pack_cut_text(message_type, text):
+    """
+    Packs a legacy (Client|Server)CutText message. Text must be Latin-1,
+    anything else raises UnicodeEncodeError rather than being mangled.
+    """
+    if isinstance(text, str):
+        text = text.encode("latin-1")
+    return struct.pack(CLIENT_CUT_TEXT, message_type, len(text)) + text
+
+
+def pack_extended(message_type, payload):
+    return struct.pack(EXTENDED_CUT_TEXT, message_type, -len(payload)) + payload
+
+
+def pack_caps(formats=FORMAT_TEXT, actions=ACTION_REQUEST | ACTION_PEEK | ACTION_NOTIFY | ACTION_PROVIDE, max_text_size=DEFAULT_MAX_TEXT_SIZE):
+    payload = struct.pack(FLAGS, ACTION_CAPS | actions | formats)
+    for _ in _formats(formats):
+        payload += struct.pack("!L", max_text_size)
+    return payload
+
+
+def pack_flags(action, formats=FORMAT_TEXT):
+    """
+    Packs a request, peek or notify, which are nothing but flags.
+    """
+    return struct.pack(FLAGS, action | formats)
+
+
+def pack_provide(text):
+    """
+    Packs a provide message carrying text as zlib compressed, null terminated
+    UTF-8 with CRLF line endings. text=None packs an empty provide, the reply
+    to a request when there's nothing to give.
+    """
+    if text is None:
+        return struct.pack(FLAGS, ACTION_PROVIDE) + zlib.compress(b"")
+    data = text.replace("\r\n", "\n").replace("\n", "\r\n").encode("utf-8") + b"\x00"
+    compressed = zlib.compress(struct.pack("!L", len(data)) + data)
+    return struct.pack(FLAGS, ACTION_PROVIDE | FORMAT_TEXT) + compressed
+
+
+def parse_caps(flags, payload):
+    """
+    Returns {format: max size} from the body of a caps message.
+    """
+    sizes = {}
+    for i, fmt in enumerate(_formats(flags & FORMAT_MASK)):
+        sizes[fmt] = struct.unpack_from("!L", payload, i * 4)[0]
+    return sizes
+
+
+def parse_provide(flags, payload):
+    """
+    Decompresses the body of a provide message and returns the text format as
+    a str, or None if the server didn't include text.
+    """
+    data = zlib.decompress(payload)
+    offset = 0
+    text = None
+    for fmt in _formats(flags & FORMAT_MASK):
+        if offset + 4 > len(data):
+            break
+        length = struct.unpack_from("!L", data, offset)[0]
+        offset += 4
+        if fmt == FORMAT_TEXT:
+            text = data[offset:offset + length].rstrip(b"\x00").decode("utf-8", errors="replace").replace("\r\n", "\n")
+        offset += length
+    return text
@@ -1,28 +1,143 @@
 import logging
+import struct
+
+from collections import deque
+from threading import Condition
+
+from .pixel_format import PixelFormat
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+SCREEN = "!LHHHHL"
+DAMAGE_HISTORY = 64 # how many changed rectangles to remember for read_changes
 
 logger = logging.getLogger(__name__)
-class Framebuffer(object):
+
+def _require_numpy():
+    if np is None:
+        raise ImportError("numpy is required for vectorized pixel operations, install it with pip install numpy")
+
+def _intersect(a, b):
+    x = max(a[0], b[0])
+    y = max(a[1], b[1])
+    right = min(a[0] + a[2], b[0] + b[2])
+    bottom = min(a[1] + a[3], b[1] + b[3])
+    if right <= x or bottom <= y:
+        return None
+    return x, y, right - x, bottom - y
+
+def _contains(outer, inner):
+    return (outer[0] <= inner[0] and outer[1] <= inner[1]
+            and inner[0] + inner[2] <= outer[0] + outer[2]
+            and inner[1] + inner[3] <= outer[1] + outer[3])
+
+def _bounding_box(rects):
+    x = min(r[0] for r in rects)
+    y = min(r[1] for r in rects)
+    right = max(r[0] + r[2] for r in rects)
+    bottom = max(r[1] + r[3] for r in rects)
+    return x, y, right - x, bottom - y
+
+class Screen(object):
     """
-    A very slow (but (hopefully?) reliable) class for tracking a framebuffer
+    A class for storing one screen of an ExtendedDesktopSize layout
     """
 
-    def __init__(self, width, height, bytes_per_pixel):
+    def __init__(self, id=0, x=0, y=0, width=0, height=0, flags=0):
+        self.id = id
+        self.x = x
+        self.y = y
         self.width = width
         self.height = height
+        self.flags = flags
+
+    def pack(self):
+        return struct.pack(SCREEN, self.id, self.x, self.y, self.width, self.height, self.flags)
+
+    @classmethod
+    def unpack(cls, data):
+        return cls(*struct.unpack(SCREEN, data))
+
+    def __repr__(self):
+        return f"Screen(id={self.id}, x={self.x}, y={self.y}, width={self.width}, height={self.height}, flags={self.flags})"
+
+class Framebuffer(object):
+    """
+    A class for tracking a framebuffer. Pixels are stored row by row in a
+    single bytearray whose capacity can be bigger than the visible size, so
+    resizing only reallocates (and copies the overlapping content) when the
+    framebuffer outgrows it.
+    """
+
+    def __init__(self, width, height, bytes_per_pixel, pixel_format=None):
+        self.width = 0
+        self.height = 0
         self.bytes_per_pixel = bytes_per_pixel
-        self.framebuffer = []
-        self._init_framebuffer()
+        self.pixel_format = pixel_format if pixel_format is not None else PixelFormat(bits_per_pixel=bytes_per_pixel * 8)
+        self.screens = [] # the server's screen layout if it supports ExtendedDesktopSize
+        self._buffer = bytearray()
+        self._capacity_width = 0
+        self._capacity_height = 0
+        self.version = 0 # bumped on every change so readers can tell if anything happened
+        self._lock = Condition() # notified whenever the version changes
+        self._damage = deque(maxlen=DAMAGE_HISTORY) # (version, x, y, width, height) of recent changes
+        self._resize_version = 0 # version of the last resize, changes from before it can't be replayed
+        self._resize(width, height)
+
+    @property
+    def _stride(self):
+        return self._capacity_width * self.bytes_per_pixel
+
+    def _offset(self, x, y):
+        return y * self._stride + x * self.bytes_per_pixel
 
-    def _init_framebuffer(self):
-        blank_pixel = b'\x00' * self.bytes_per_pixel
-        blank_row = [blank_pixel] * self.width
-        for _ in range(self.height):
-            self.framebuffer.append(blank_row.copy())
+    def _clear(self, x, y, width, height):
+        blank_row = bytes(width * self.bytes_per_pixel)
+        for row in range(y, y + height):
+            offset = self._offset(x, row)
+            self._buffer[offset : offset + len(blank_row)] = blank_row
 
-    def resize(self, width, height):
+    def _resize(self, width, height):
+        old_width, old_height = self.width, self.height
+        capacity_width, capacity_height = self._capacity_width, self._capacity_height
+        too_small = width > capacity_width or height > capacity_height
+        # give memory back if the framebuffer shrinks to well under its capacity
+        too_big = width * height * 4 < capacity_width * capacity_height
+        if too_small or too_big:
+            if too_small:
+                # grow by at least half again so repeated small resizes are amortized
+                capacity_width = max(width, capacity_width + capacity_width // 2) if width > capacity_width else capacity_width
+                capacity_height = max(height, capacity_height + capacity_height // 2) if height > capacity_height else capacity_height
+            else:
+                capacity_width, capacity_height = width, height
+            old_buffer, old_stride = self._buffer, self._stride
+            self._capacity_width, self._capacity_height = capacity_width, capacity_height
+            self._buffer = bytearray(self._stride * capacity_height)
+            # keep the content that's still on screen
+            row_length = min(old_width, width) * self.bytes_per_pixel
+            for row in range(min(old_height, height)):
+                self._buffer[row * self._stride : row * self._stride + row_length] = old_buffer[row * old_stride : row * old_stride + row_length]
+        else:
+            # blank anything newly exposed, it may hold pixels from before a shrink
+            if width > old_width:
+                self._clear(old_width, 0, width - old_width, min(old_height, height))
+            if height > old_height:
+                self._clear(0, old_height, width, height - old_height)
         self.width = width
         self.height = height
-        self._init_framebuffer()
+
+    def resize(self, width, height, screens=None):
+        with self._lock:
+            self._resize(width, height)
+            if screens is not None:
+                self.screens = screens
+            self.version += 1
+            self._resize_version = self.version
+            self._damage.clear()
+            self._lock.notify_all()
 
     def set_pixels(self, x_position, y_position, width, height, pixel_bytes):
         """
@@ -32,43 +147,213 @@ class Framebuffer(object):
         """
 
         logger.debug(f"Setting pixels at x={x_position} y={y_position} width={width} height={height}")
-        pixel_matrix = []
+        row_length = width * self.bytes_per_pixel
         # check to see if pixel_bytes is properly divisible
-        if len(pixel_bytes) % (width * self.bytes_per_pixel) != 0:
-            raise ValueError(f"Number of pixel bytes received ({len(pixel_bytes)}) is not divisible by width * bytes_per_pixel ({width * self.bytes_per_pixel}).")
-        for i in range(height):
-            row = []
-            for j in range(0, len(pixel_bytes) // height, self.bytes_per_pixel):
-                row.append(pixel_bytes[i * width * self.bytes_per_pixel + j : i * width * self.bytes_per_pixel + j + self.bytes_per_pixel])
-            pixel_matrix.append(row)
-
-        # check if the framebuffer needs to be resized based on the x, y, width, height
-        need_resize = False
-        if x_position + width > self.width:
-            self.width = x_position + width
-            need_resize = True
-        if y_position + height > self.height:
-            self.height = y_position + height
-            need_resize = True
-        if need_resize:
-            self._init_framebuffer()
-
-        for i, row in enumerate(pixel_matrix):
-            #if logger.level <= logging.DEBUG: # don't do this extra logic unless debug is on
-                #row_log = b"".join(row)
-                #old_row_log = b"".join(self.framebuffer[y_position + i][x_position : x_position + width])
-                #logger.debug(f"Old row: \n{old_row_log}\nNew row:\n{row_log}")
-            self.framebuffer[y_position + i][x_position : x_position + width] = row
+        if row_length == 0:
+            return
+        if len(pixel_bytes) % row_length != 0 or len(pixel_bytes) < row_length * height:
+            raise ValueError(f"Number of pixel bytes received ({len(pixel_bytes)}) does not match width * height * bytes_per_pixel ({row_length * height}).")
+        pixels = memoryview(pixel_bytes)
+
+        with self._lock:
+            # check if the framebuffer needs to be resized based on the x, y, width, height
+            resized = x_position + width > self.width or y_position + height > self.height
+            if resized:
+                self._resize(max(self.width, x_position + width), max(self.height, y_position + height))
+                self._resize_version = self.version + 1
+                self._damage.clear()
+
+            # compare row by row (slicing the bytearray is a fast memcmp, unlike
+            # comparing memoryviews) and only copy the rows that changed
+            changed_rows = []
+            offset = self._offset(x_position, y_position)
+            for i in range(height):
+                row = pixels[i * row_length : (i + 1) * row_length]
+                if self._buffer[offset : offset + row_length] != row:
+                    self._buffer[offset : offset + row_length] = row
+                    changed_rows.append(i)
+                offset += self._stride
+            if not changed_rows and not resized:
+                # the server resent what we already have (ie a full refresh), keep the version so readers can skip it
+                return
+            self.version += 1
+            if changed_rows:
+                self._damage.append((self.version, x_position, y_position + changed_rows[0], width, changed_rows[-1] - changed_rows[0] + 1))
+            self._lock.notify_all()
         logger.debug("Done setting pixels")
 
+    def _read_rect(self, x, y, width, height):
+        row_length = width * self.bytes_per_pixel
+        offset = self._offset(x, y)
+        if row_length == self._stride:
+            return bytes(self._buffer[offset : offset + row_length * height])
+        buffer = memoryview(self._buffer)
+        return b"".join(buffer[self._offset(x, row) : self._offset(x, row) + row_length] for row in range(y, y + height))
+
     def flatten(self):
         """
-        Flattens the 2D array of byte strings to a single string of bytes
+        Returns the framebuffer as a single string of bytes
+        """
+        with self._lock:
+            return self._read_rect(0, 0, self.width, self.height)
+
+    def snapshot(self):
+        """
+        Returns a consistent copy of the framebuffer as (pixel_bytes, width,
+        height, version). This is the only work done on the caller's thread
+        when taking a screenshot.
+        """
+        with self._lock:
+            return self._read_rect(0, 0, self.width, self.height), self.width, self.height, self.version
+
+    def read_changes(self, since_version=None, rect=None, max_rects=16, pending=None):
+        """
+        Returns (version, width, height, rects) where rects is a list of
+        (x, y, width, height, pixel_bytes) covering everything inside rect that
+        changed after since_version. If since_version is None, predates the
+        remembered history or a resize, the whole rect is returned. More than
+        max_rects changes are merged into their bounding box.
+
+        pending is an optional list of changed rects the caller hasn't sent
+        yet. They're read as if they changed after since_version, and the list
+        is updated in place with the changes that didn't fit inside rect.
+        """
+        with self._lock:
+            bounds = self._clip_rect(rect)
+            changed = self._damage_since(since_version)
+            if changed is None:
+                changed = [(0, 0, self.width, self.height)]
+            if pending is not None:
+                screen = (0, 0, self.width, self.height)
+                # a resize may have left some of them outside the framebuffer
+                changed = [r for r in (_intersect(r, screen) for r in pending + changed) if r is not None]
+                pending[:] = [r for r in changed if not _contains(bounds, r)]
+                if len(pending) > max_rects:
+                    pending[:] = [_bounding_box(pending)]
+            changed = [r for r in (_intersect(r, bounds) for r in changed) if r is not None]
+            if len(changed) > max_rects:
+                changed = [_bounding_box(changed)]
+            rects = [(x, y, width, height, self._read_rect(x, y, width, height)) for x, y, width, height in changed]
+            return self.version, self.width, self.height, rects
+
+    def _damage_since(self, version):
+        if version is None or version < self._resize_version:
+            return None
+        if version >= self.version:
+            return []
+        if not self._damage or self._damage[0][0] > version + 1:
+            # history has been dropped, don't know what changed
+            return None
+        return [damage[1:] for damage in self._damage if damage[0] > version]
+
+    def _clip_rect(self, rect):
+        """
+        Clips an (x, y, width, height) rect to the framebuffer. None means the
+        whole framebuffer.
+        """
+        if rect is None:
+            return 0, 0, self.width, self.height
+        x, y, width, height = rect
+        # clip both edges, a rect hanging off the left or top keeps only its visible part
+        right = min(max(x + width, 0), self.width)
+        bottom = min(max(y + height, 0), self.height)
+        x = min(max(x, 0), self.width)
+        y = min(max(y, 0), self.height)
+        return x, y, max(right - x, 0), max(bottom - y, 0)
+
+    def get_pixel(self, x, y):
+        """
+        Returns the raw bytes of the pixel at x, y in the negotiated pixel
+        format.
+        """
+        with self._lock:
+            if not (0 <= x < self.width and 0 <= y < self.height):
+                raise IndexError(f"Pixel {x}, {y} is outside the {self.width}x{self.height} framebuffer")
+            offset = self._offset(x, y)
+            return bytes(self._buffer[offset : offset + self.bytes_per_pixel])
+
+    def get_color(self, x, y):
+        """
+        Returns the pixel at x, y as an (r, g, b) tuple in 0-255.
+        """
+        return self.pixel_format.pixel_to_rgb(self.get_pixel(x, y))
+
+    def read_rect(self, rect=None):
+        """
+        Returns the raw pixel bytes of an (x, y, width, height) rect, row by
+        row, in the negotiated pixel format.
+        """
+        with self._lock:
+            return self._read_rect(*self._clip_rect(rect))
+
+    def _view(self, x, y, width, height):
+        pixels = np.frombuffer(self._buffer, dtype=np.uint8).reshape(self._capacity_height, self._capacity_width, self.bytes_per_pixel)
+        return pixels[y : y + height, x : x + width]
+
+    def get_region(self, rect=None, copy=True):
+        """
+        Returns an (x, y, width, height) rect as a uint8 numpy array shaped
+        (height, width, bytes_per_pixel) in the negotiated pixel format. With
+        copy=False the array is a view of the live framebuffer, which is free
+        but keeps changing as updates arrive and stops tracking it after a
+        resize.
+        """
+        _require_numpy()
+        with self._lock:
+            region = self._view(*self._clip_rect(rect))
+            return region.copy() if copy else region
+
+    def get_region_rgb(self, rect=None):
+        """
+        Same as get_region, but decoded to (height, width, 3) RGB.
+        """
+        _require_numpy()
+        with self._lock:
+            return self.pixel_format.decode_rgb(self._view(*self._clip_rect(rect)))
+
+    def _color_mask(self, color, rect, tolerance):
+        # rect must already be clipped and the lock held, so a resize can't
+        # change the geometry between clipping and reading
+        rgb = self.pixel_format.decode_rgb(self._view(*rect)).astype(np.int16)
+        return np.all(np.abs(rgb - np.array(color, dtype=np.int16)) <= tolerance, axis=-1)
+
+    def find_color(self, color, rect=None, tolerance=0):
+        """
+        Returns the (x, y) of the first pixel in rect (scanning row by row)
+        whose r, g and b are each within tolerance of color, or None.
+        """
+        _require_numpy()
+        with self._lock:
+            x, y, width, height = self._clip_rect(rect)
+            mask = self._color_mask(color, (x, y, width, height), tolerance)
+        index = np.flatnonzero(mask)
+        if index.size == 0:
+            return None
+        row, column = divmod(int(index[0]), width)
+        return x + column, y + row
+
+    def count_color(self, color, rect=None, tolerance=0):
+        """
+        Returns the number of pixels in rect within tolerance of color.
+        """
+        _require_numpy()
+        with self._lock:
+            mask = self._color_mask(color, self._clip_rect(rect), tolerance)
+        return int(np.count_nonzero(mask))
+
+    def region_mean(self, rect=None):
+        """
+        Returns the mean (r, g, b) of rect as floats.
         """
-        return b"".join(map(lambda x: b"".join(x), self.framebuffer))
+        rgb = self.get_region_rgb(rect)
+        if rgb.size == 0:
+            return None
+        return tuple(float(c) for c in rgb.reshape(-1, 3).mean(axis=0))
 
     def __str__(self):
         s = ""
-        for row in self.framebuffer:
-            s += str(row) + "\n"
+        row_length = self.width * self.bytes_per_pixel
+        for row in range(self.height):
+            offset = self._offset(0, row)
+            s += str(bytes(self._buffer[offset : offset + row_length])) + "\n"
         return s
@@ -1,6 +1,20 @@
 import struct
 
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
 PIXEL_FORMAT = "BBBBHHHBBBxxx"
+
+def _wire_u16(value):
+    """
+    The max fields are packed in native byte order, so the defaults are given
+    pre-swapped (65280 is 255 on the wire from a little endian host). Returns
+    the value the server actually sees.
+    """
+    return struct.unpack("!H", struct.pack("H", value))[0]
+
 class PixelFormat(object):
     """
     A class for storing the PixelFormat struct
@@ -22,3 +36,73 @@ class PixelFormat(object):
 
     def pack(self):
         return struct.pack(PIXEL_FORMAT, self.bits_per_pixel, self.depth, self.big_endian_flag, self.true_color_flag, self.red_max, self.green_max, self.blue_max, self.red_shift, self.green_shift, self.blue_shift)
+
+    @property
+    def bytes_per_pixel(self):
+        return self.bits_per_pixel // 8
+
+    def channels(self):
+        """
+        Returns [(shift, max)] for red, green and blue as the server interprets
+        them.
+        """
+        return [
+            (self.red_shift, _wire_u16(self.red_max)),
+            (self.green_shift, _wire_u16(self.green_max)),
+            (self.blue_shift, _wire_u16(self.blue_max)),
+        ]
+
+    def _byte_order(self):
+        return "big" if self.big_endian_flag else "little"
+
+    def pixel_to_rgb(self, pixel_bytes):
+        """
+        Converts a single pixel in this format to an (r, g, b) tuple scaled to
+        0-255.
+        """
+        value = int.from_bytes(pixel_bytes, self._byte_order())
+        return tuple(((value >> shift) & max_) * 255 // max_ for shift, max_ in self.channels())
+
+    def rgb_to_pixel(self, rgb):
+        """
+        Converts an (r, g, b) tuple in 0-255 to a single pixel in this format.
+        """
+        value = 0
+        for component, (shift, max_) in zip(rgb, self.channels()):
+            value |= (component * max_ // 255) << shift
+        return value.to_bytes(self.bytes_per_pixel, self._byte_order())
+
+    def numpy_dtype(self):
+        """
+        The numpy dtype of one pixel value in this format.
+        """
+        if np is None:
+            raise ImportError("numpy is required for vectorized pixel operations")
+        return np.dtype(f"{'>' if self.big_endian_flag else '<'}u{self.bytes_per_pixel}")
+
+    def decode_rgb(self, pixels):
+        """
+        Converts an array of pixels shaped (..., bytes_per_pixel) in this
+        format to an array of the same shape with 3 uint8 RGB channels.
+        """
+        values = np.ascontiguousarray(pixels).view(self.numpy_dtype())[..., 0]
+        rgb = np.empty(values.shape + (3,), dtype=np.uint8)
+        for i, (shift, max_) in enumerate(self.channels()):
+            channel = (values >> shift) & max_
+            if max_ != 255:
+                channel = channel.astype(np.uint32) * 255 // max_
+            rgb[..., i] = channel
+        return rgb
+
+    def encode_rgb(self, rgb):
+        """
+        The inverse of decode_rgb, converts an array of uint8 RGB shaped
+        (..., 3) to pixels shaped (..., bytes_per_pixel) in this format.
+        """
+        values = np.zeros(rgb.shape[:-1], dtype=np.uint32)
+        for i, (shift, max_) in enumerate(self.channels()):
+            channel = rgb[..., i].astype(np.uint32)
+            if max_ != 255:
+                channel = channel * max_ // 255
+            values |= channel << shift
+        return values.astype(self.numpy_dtype()).view(np.uint8).reshape(rgb.shape[:-1] + (self.bytes_per_pixel,))
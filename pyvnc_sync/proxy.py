@@ -0,0 +1,376 @@
+import logging
+import selectors
+import socket
+import struct
+
+from collections import deque
+from threading import Thread, Lock, Condition
+
+from . import clipboard
+from .pixel_format import PixelFormat, PIXEL_FORMAT
+from .pyvnc_sync import U16, U32, S32, RAW_ENCODING, DESKTOP_SIZE_ENCODING, CLIENT_CUT_TEXT
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+FRAMEBUFFER_UPDATE = "!BxH"
+RECTANGLE = "!HHHHl"
+SERVER_CUT_TEXT = 3
+OUTGOING_QUEUE_SIZE = 16 # server messages (ie clipboard) queued per downstream client before new ones are dropped
+
+logger = logging.getLogger(__name__)
+
+def _same_layout(a, b):
+    """
+    True if pixels in format a can be sent as-is to a client expecting b.
+    """
+    return (a.bits_per_pixel == b.bits_per_pixel
+            and a.channels() == b.channels()
+            and (a.big_endian_flag == b.big_endian_flag or a.bits_per_pixel == 8))
+
+
+class _Downstream(object):
+    """
+    One local RFB client attached to the proxy. A reader thread handles its
+    messages and forwards input upstream, a writer thread answers its
+    framebuffer update requests from the cached framebuffer and sends any
+    queued server messages. Nothing else writes to its socket after the
+    handshake, so a slow client can't hold up the upstream connection.
+    """
+
+    def __init__(self, proxy, sock, address):
+        self.proxy = proxy
+        self.socket = sock
+        self.address = address
+        self.pixel_format = proxy.client.pixel_format
+        self.supports_desktop_size = False
+        self.size = None # framebuffer size the client was last told about
+        self._send_lock = Lock()
+        self._condition = Condition()
+        self._request = None # (incremental, x, y, width, height) of the pending update request
+        self._outgoing = deque() # server messages waiting for the writer thread
+        self._closed = False
+        self.ready = False # set once the handshake is done and it's safe to send server messages
+        self._recv_buffer = bytearray()
+        self._reader = Thread(target=self._read_loop, name=f"vnc-proxy-reader-{address}", daemon=True)
+        self._writer = Thread(target=self._write_loop, name=f"vnc-proxy-writer-{address}", daemon=True)
+
+    def start(self):
+        self._reader.start()
+
+    def close(self):
+        with self._condition:
+            if self._closed:
+                return
+            self._closed = True
+            self._condition.notify_all()
+        try:
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.socket.close()
+        self.proxy._remove_downstream(self)
+
+    def _full_recv(self, bufsize):
+        while len(self._recv_buffer) < bufsize:
+            data = self.socket.recv(65536)
+            if not data:
+                raise ConnectionResetError("Downstream client closed the connection")
+            self._recv_buffer += data
+        data = bytes(self._recv_buffer[:bufsize])
+        del self._recv_buffer[:bufsize]
+        return data
+
+    def send(self, *buffers):
+        with self._send_lock:
+            for buffer in buffers:
+                self.socket.sendall(buffer)
+
+    def queue_message(self, message):
+        """
+        Queues a server message for the writer thread. If the client has
+        fallen too far behind to take it, the message is dropped.
+        """
+        with self._condition:
+            if self._closed:
+                return
+            if len(self._outgoing) >= OUTGOING_QUEUE_SIZE:
+                logger.warning(f"Downstream client {self.address} is falling behind, dropping a message")
+                return
+            self._outgoing.append(message)
+            self._condition.notify_all()
+
+    def wake(self):
+        """
+        Wakes the writer thread to check for framebuffer changes. Called by
+        the proxy after every upstream update.
+        """
+        with self._condition:
+            self._condition.notify_all()
+
+    def _handshake(self):
+        self.send(b'RFB 003.008\x0a')
+        version = self._full_recv(12)
+        if version == b'RFB 003.003\x0a':
+            # 3.3 clients don't get to choose, the server picks
+            self.send(struct.pack(U32, 1))
+        else:
+            # only offer no authentication, the proxy is meant to listen locally
+            self.send(struct.pack("BB", 1, 1))
+            if self._full_recv(1) != b'\x01':
+                raise ConnectionRefusedError("Downstream client chose an unsupported security type")
+            if version == b'RFB 003.008\x0a':
+                self.send(struct.pack(U32, 0))
+        self._full_recv(1) # ClientInit, every client is shared
+        framebuffer = self.proxy.client.framebuffer
+        name = self.proxy.desktop_name
+        self.size = (framebuffer.width, framebuffer.height)
+        self.send(struct.pack("!HH", framebuffer.width, framebuffer.height) + self.pixel_format.pack() + struct.pack(U32, len(name)) + name)
+
+    def _read_loop(self):
+        try:
+            self._handshake()
+            logger.info(f"Downstream client {self.address} connected")
+            self.ready = True
+            self._writer.start()
+            while True:
+                self._handle_message(self._full_recv(1)[0])
+        except (ConnectionError, OSError) as e:
+            if not self._closed:
+                logger.info(f"Downstream client {self.address} disconnected: {e}")
+        except Exception:
+            logger.exception(f"Dropping downstream client {self.address}")
+        finally:
+            self.close()
+
+    def _handle_message(self, message_type):
+        client = self.proxy.client
+        if message_type == 0:
+            # SetPixelFormat
+            pixel_format = PixelFormat(*struct.unpack(PIXEL_FORMAT, self._full_recv(19)[3:]))
+            if not _same_layout(client.pixel_format, pixel_format):
+                if not pixel_format.true_color_flag:
+                    raise ValueError("Downstream client asked for a color map pixel format, which isn't supported")
+                if np is None:
+                    raise ImportError("numpy is required to translate pixels to a downstream client's pixel format")
+            with self._condition:
+                self.pixel_format = pixel_format
+        elif message_type == 2:
+            # SetEncodings, only raw is ever sent
+            number_of_encodings = _unpack(U16, self._full_recv(3)[1:])
+            encodings = struct.unpack(f"!{number_of_encodings}l", self._full_recv(number_of_encodings * 4))
+            self.supports_desktop_size = DESKTOP_SIZE_ENCODING in encodings
+        elif message_type == 3:
+            # FramebufferUpdateRequest
+            with self._condition:
+                self._request = struct.unpack("!BHHHH", self._full_recv(9))
+                self._condition.notify_all()
+        elif message_type in (4, 5):
+            # KeyEvent and PointerEvent are forwarded upstream untouched
+            client.send_message(bytes([message_type]) + self._full_recv(7 if message_type == 4 else 5))
+        elif message_type == CLIENT_CUT_TEXT:
+            length = _unpack(S32, self._full_recv(7)[3:])
+            if length < 0:
+                # extended clipboard isn't offered downstream, skip it
+                self._full_recv(-length)
+            else:
+                client.set_clipboard(self._full_recv(length).decode("latin-1"))
+        else:
+            raise ValueError(f"Downstream client sent unsupported message type {message_type}")
+
+    def _write_loop(self):
+        client = self.proxy.client
+        sent_version = None
+        sent_framebuffer = None
+        sent_size = self.size
+        pending = [] # changes outside earlier requests, sent once a request covers them
+        idle = None # (request, framebuffer, version) that had nothing to send
+        try:
+            while True:
+                with self._condition:
+                    self._condition.wait_for(lambda: self._closed or self._outgoing
+                                             or (self._request is not None and (self._request, client.framebuffer, client.framebuffer.version) != idle))
+                    if self._closed:
+                        return
+                    outgoing = list(self._outgoing)
+                    self._outgoing.clear()
+                    request = self._request
+                    pixel_format = self.pixel_format
+                if outgoing:
+                    self.send(*outgoing)
+                framebuffer = client.framebuffer
+                if request is None or (request, framebuffer, framebuffer.version) == idle:
+                    continue
+                incremental, x, y, width, height = request
+
+                if framebuffer is not sent_framebuffer:
+                    # the client reconnected and started a new framebuffer
+                    sent_version = None
+                    sent_framebuffer = framebuffer
+                    pending = []
+                since = sent_version if incremental else None
+                header = []
+                if (framebuffer.width, framebuffer.height) != sent_size:
+                    if sent_size is not None and self.supports_desktop_size:
+                        header.append(struct.pack(RECTANGLE, 0, 0, framebuffer.width, framebuffer.height, DESKTOP_SIZE_ENCODING))
+                        x, y, width, height = 0, 0, framebuffer.width, framebuffer.height
+                    since = None
+
+                version, fb_width, fb_height, rects = framebuffer.read_changes(since, (x, y, width, height), pending=pending)
+                sent_version = version
+                if not rects and not header:
+                    # nothing new inside the requested area, anything outside it stays pending
+                    idle = (request, framebuffer, version)
+                    continue
+                idle = None
+                with self._condition:
+                    if self._request == request:
+                        self._request = None
+                self._send_update(header, rects, framebuffer.pixel_format, pixel_format)
+                sent_size = (fb_width, fb_height)
+        except (ConnectionError, OSError) as e:
+            if not self._closed:
+                logger.info(f"Downstream client {self.address} disconnected: {e}")
+        except Exception:
+            logger.exception(f"Dropping downstream client {self.address}")
+        finally:
+            self.close()
+
+    def _send_update(self, header, rects, source_format, target_format):
+        translate = not _same_layout(source_format, target_format)
+        buffers = [struct.pack(FRAMEBUFFER_UPDATE, 0, len(header) + len(rects))] + header
+        for x, y, width, height, pixel_bytes in rects:
+            if translate:
+                pixels = np.frombuffer(pixel_bytes, dtype=np.uint8).reshape(height, width, source_format.bytes_per_pixel)
+                pixel_bytes = target_format.encode_rgb(source_format.decode_rgb(pixels)).tobytes()
+            buffers.append(struct.pack(RECTANGLE, x, y, width, height, RAW_ENCODING))
+            buffers.append(pixel_bytes)
+        self.send(*buffers)
+
+
+def _unpack(t, data):
+    return struct.unpack(t, data)[0]
+
+
+class VNCProxy(Thread):
+    """
+    Shares one SyncVNCClient connection with any number of local RFB clients.
+    Downstream clients are served from the client's cached framebuffer and
+    their keyboard, pointer and clipboard input is forwarded upstream, so the
+    upstream connection only ever carries one update stream.
+
+    Downstream clients aren't authenticated, so keep the default of listening
+    on localhost.
+    """
+
+    def __init__(self, client, host="127.0.0.1", port=5901, desktop_name=None):
+        super().__init__(name="vnc-proxy", daemon=True)
+        self.client = client
+        self.host = host
+        self.port = port
+        self.desktop_name = desktop_name if desktop_name is not None else client.vnc_name
+        if isinstance(self.desktop_name, str):
+            self.desktop_name = self.desktop_name.encode("utf-8")
+        self._please_stop = False
+        self._updates = 0 # upstream updates seen, guarded by _downstreams_condition
+        self._downstreams = []
+        self._downstreams_condition = Condition()
+        self._selector = selectors.DefaultSelector()
+        self._wakeup_recv, self._wakeup_send = socket.socketpair()
+        self._wakeup_recv.setblocking(False)
+        self._selector.register(self._wakeup_recv, selectors.EVENT_READ)
+        self.listen_socket = socket.socket(socket.AF_INET6 if ":" in host else socket.AF_INET, socket.SOCK_STREAM)
+        self.listen_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listen_socket.bind((host, port))
+        self.listen_socket.listen()
+        self.port = self.listen_socket.getsockname()[1]
+        self._selector.register(self.listen_socket, selectors.EVENT_READ)
+        self._pump = Thread(target=self._pump_updates, name="vnc-proxy-upstream", daemon=True)
+
+    def run(self):
+        self.client.add_clipboard_callback(self._on_clipboard)
+        self.client.add_update_callback(self._on_update)
+        self._pump.start()
+        try:
+            while not self._please_stop:
+                for key, _ in self._selector.select():
+                    if key.fileobj is self.listen_socket and not self._please_stop:
+                        sock, address = self.listen_socket.accept()
+                        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                        downstream = _Downstream(self, sock, address)
+                        with self._downstreams_condition:
+                            self._downstreams.append(downstream)
+                            self._downstreams_condition.notify_all()
+                        downstream.start()
+        finally:
+            self.client.remove_clipboard_callback(self._on_clipboard)
+            self.client.remove_update_callback(self._on_update)
+
+    def stop(self):
+        self._please_stop = True
+        self._wakeup_send.send(b'\x00')
+        with self._downstreams_condition:
+            downstreams = list(self._downstreams)
+            self._downstreams_condition.notify_all()
+        for downstream in downstreams:
+            downstream.close()
+        if self.is_alive():
+            self.join()
+        if self._pump.is_alive():
+            self._pump.join()
+        self._selector.close()
+        self.listen_socket.close()
+        self._wakeup_recv.close()
+        self._wakeup_send.close()
+
+    def _remove_downstream(self, downstream):
+        with self._downstreams_condition:
+            if downstream in self._downstreams:
+                self._downstreams.remove(downstream)
+
+    def _pump_updates(self):
+        """
+        Keeps exactly one incremental update request outstanding upstream
+        while anyone is attached, no matter how many downstream clients there
+        are. The next request is only sent once an update has arrived.
+        """
+        client = self.client
+        framebuffer = None
+        updates = None
+        while True:
+            with self._downstreams_condition:
+                # wait until someone is attached and the outstanding request has been answered
+                self._downstreams_condition.wait_for(lambda: self._please_stop or (self._downstreams and (self._updates != updates or client.framebuffer is not framebuffer)))
+                if self._please_stop:
+                    return
+                # ask for everything the first time and after the client reconnects
+                incremental = client.framebuffer is framebuffer
+                framebuffer = client.framebuffer
+                updates = self._updates
+            try:
+                client.request_framebuffer_update(incremental=incremental)
+            except ConnectionError as e:
+                # the client was stopped, its reconnect callback will wake us if it comes back
+                logger.warning(f"Couldn't request an upstream update: {e}")
+
+    def _on_update(self, framebuffer):
+        # runs on the client's receive thread, so only wake the threads that do the work
+        with self._downstreams_condition:
+            self._updates += 1
+            self._downstreams_condition.notify_all()
+            downstreams = list(self._downstreams)
+        for downstream in downstreams:
+            downstream.wake()
+
+    def _on_clipboard(self, text):
+        # runs on the client's receive thread, so only queue it. downstream
+        # clients only get legacy cut text, so characters outside Latin-1
+        # (which the extended clipboard allows) can't be passed on
+        message = clipboard.pack_cut_text(SERVER_CUT_TEXT, text.encode("latin-1", errors="replace"))
+        with self._downstreams_condition:
+            downstreams = list(self._downstreams)
+        for downstream in downstreams:
+            if downstream.ready:
+                downstream.queue_message(message)
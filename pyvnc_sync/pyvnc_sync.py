@@ -1,18 +1,24 @@
 import logging
+import selectors
 import socket
 import struct
 import time
+import warnings
 
+from collections import deque
 from des import DesKey
 from PIL import Image
-from threading import Thread, Lock
+from threading import Thread, Lock, Event, Condition
 
+from . import clipboard
 from . import keysym
-from .framebuffer import Framebuffer
+from .framebuffer import Framebuffer, Screen, SCREEN
 from .pixel_format import PixelFormat
 from .pixel_format import PIXEL_FORMAT
+from .screenshot import ScreenshotEncoder
 
-CHUNK_SIZE = 4096 #65536 #Maybe receiving 64KB at a time will make these framebuffer updates faster?
+CHUNK_SIZE = 65536 # reads smaller than this are buffered, larger ones are received straight into their destination
+MIN_RETRY_SLEEP = 0.5 # never retry a failed connection faster than this, whatever retry_sleep says
 
 HANDSHAKE = ""
 SET_PIXEL_FORMAT = "Bxxx16s"
@@ -30,6 +36,20 @@ STRING = "{}s"
 
 RAW_ENCODING = 0
 DESKTOP_SIZE_ENCODING = -223
+EXTENDED_DESKTOP_SIZE_ENCODING = -308
+EXTENDED_CLIPBOARD_ENCODING = clipboard.EXTENDED_CLIPBOARD_ENCODING
+
+CLIENT_CUT_TEXT = 6
+SET_DESKTOP_SIZE = "!BxHHBx"
+
+# ExtendedDesktopSize reasons (x-position) and status codes (y-position)
+DESKTOP_SIZE_REASON_CLIENT = 1
+DESKTOP_SIZE_STATUS = {
+    0: "No error",
+    1: "Resize is administratively prohibited",
+    2: "Out of resources",
+    3: "Invalid screen layout",
+}
 
 logger = logging.getLogger(__name__)
 
@@ -46,26 +66,46 @@ def _unpack_single(t, data):
 class VNCUnsupportedSecurityTypes(Exception):
     pass
 
+class VNCDesktopSizeError(Exception):
+    pass
+
+class _RecvInterrupted(Exception):
+    """
+    Raised out of a blocking receive when the wakeup socket fires, either
+    because stop() was called or because another thread is reconnecting.
+    """
+    pass
+
 class SyncVNCClient(Thread):
     """
     Synchronous VNC client. The goal is to be as stupid simple and barebones as
     possible.
     """
 
-    def __init__(self, hostname, port=5900, password=None, share=False, pixel_format=PixelFormat(), log_level=logging.INFO, recv_socket_timeout=1):
+    def __init__(self, hostname, port=5900, password=None, share=False, pixel_format=PixelFormat(), log_level=logging.INFO, recv_socket_timeout=None, recv_buffer_size=None, send_buffer_size=None, screenshot_workers=2):
         super().__init__()
         self._running = False
         logger.setLevel(log_level)
-        self.recv_socket_timeout = recv_socket_timeout
-        self._socket_lock = Lock()
+        if recv_socket_timeout is not None:
+            # the reader waits on a selector now, so there's no timeout to set
+            warnings.warn("recv_socket_timeout is ignored and will be removed", DeprecationWarning, stacklevel=2)
+        self.recv_buffer_size = recv_buffer_size # SO_RCVBUF, None keeps the OS default
+        self.send_buffer_size = send_buffer_size # SO_SNDBUF, None keeps the OS default
         self.hostname = hostname
         self.port = port
-        self.running = False
-        self._send_socket_lock = Lock() # these locks are grabbed before using the socket. both are grabbed while (re)connecting
-        self._recv_socket_lock = Lock()
-        self._reconnecting_lock = Lock() # do a non blocking grab on this lock while reconnecting if either socket fails
-        self.send_socket = None
-        self.recv_socket = None
+        self._send_lock = Lock() # held while draining the send queue. both locks are grabbed while (re)connecting
+        self._recv_lock = Lock() # held by whichever thread is reading from the socket
+        self._reconnecting_lock = Lock()
+        self._send_queue = deque() # outgoing messages, drained in order by whichever sender holds the send lock
+        self._recv_buffer = bytearray()
+        self.socket = None
+        # the reader waits on the socket and the wakeup socket so stop() and
+        # reconnects can interrupt it without polling
+        self._selector = selectors.DefaultSelector()
+        self._wakeup_recv, self._wakeup_send = socket.socketpair()
+        self._wakeup_recv.setblocking(False)
+        self._wakeup_send.setblocking(False)
+        self._selector.register(self._wakeup_recv, selectors.EVENT_READ)
         self.password = password 
         self.share=share
         self.framebuffer = Framebuffer(0, 0, 4)
@@ -73,51 +113,112 @@ class SyncVNCClient(Thread):
         self.server_pixel_format = None
         self.vnc_name = ""
         self.mouse_buttons = 0x00
-        self._framebuffer_updated = False
+        self._framebuffer_updated = Event()
+        self._update_callbacks = []
         self._please_stop = False
+        self._stopped = Event() # set by stop() to cut short the wait between reconnect attempts
         self._connected_and_initialized = False
         self.first_screenshot = True
+        self._screenshot_encoder = ScreenshotEncoder(max_workers=screenshot_workers)
         self._reconnecting = False
+        self.clipboard = None # last clipboard text received from the server
+        self._clipboard_condition = Condition()
+        self._clipboard_serial = 0 # bumped every time the server sends clipboard text
+        self._clipboard_callbacks = []
+        self._local_clipboard = None # text we've announced and will provide when the server asks
+        self._server_clipboard_caps = None # {format: max size} once the server offers the extended clipboard
+        self._server_clipboard_flags = 0
+        self.supports_set_desktop_size = False # set once the server sends an ExtendedDesktopSize rectangle
+        self._desktop_size_reply = Event()
+        self._desktop_size_status = None
         self._offset = 0 # sometimes clicks in the same spot don't work?? flip this and add to mouse location to make subsequent clicks always different. super hacky
         self._connect()
     
     def __del__(self):
         if self._running:
             self.stop()
-        if self.send_socket is not None:
-            self.send_socket.close()
-        if self.recv_socket is not None:
-            self.recv_socket.close()
+        if self.socket is not None:
+            self.socket.close()
+        self._selector.close()
+        self._wakeup_recv.close()
+        self._wakeup_send.close()
+
+    def _open_socket(self):
+        """
+        Same as socket.create_connection, except the buffer sizes are applied
+        before connecting so they are taken into account for the TCP window.
+        """
+        error = None
+        for family, type_, proto, _, address in socket.getaddrinfo(self.hostname, self.port, 0, socket.SOCK_STREAM):
+            sock = socket.socket(family, type_, proto)
+            try:
+                if self.recv_buffer_size is not None:
+                    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.recv_buffer_size)
+                if self.send_buffer_size is not None:
+                    sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.send_buffer_size)
+                # queued messages are already coalesced into a single send
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                sock.connect(address)
+                return sock
+            except OSError as e:
+                error = e
+                sock.close()
+        if error is None:
+            error = ConnectionError(f"Could not resolve {self.hostname}")
+        raise error
+
+    def _wakeup(self):
+        try:
+            self._wakeup_send.send(b'\x00')
+        except BlockingIOError:
+            pass # a wakeup is already pending
+
+    def _drain_wakeup(self):
+        try:
+            while self._wakeup_recv.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
     
-    def _connect(self, retries=0, retry_sleep=0):
-        # try to acquire the reconnect lock. if it's already acquired, another thread is already reconnecting
+    def _connect(self, retries=0, retry_sleep=0, failed_socket=None):
+        # only one thread reconnects at a time. anyone else waiting on the lock
+        # will find the connection already re-established and return
         with self._reconnecting_lock:
+            logger.debug("(Re)connect lock acquired.")
+            if failed_socket is not None:
+                if failed_socket is not self.socket:
+                    # another thread already replaced the failed socket. don't
+                    # wake the reader, it may be partway through a message
+                    logger.debug("Connection was already re-established.")
+                    return
+                self._connected_and_initialized = False
+            if self._connected_and_initialized:
+                return
             try:
                 self._reconnecting = True
-                logger.debug("(Re)connect lock acquired.")
+                # kick the reader out of its wait so it gives up the recv lock
+                self._wakeup()
                 tries = 0
-                # try to (re)connect until successful
-                logger.debug(f"(Re)connect waiting for send socket lock.")
-                with self._send_socket_lock:
-                    logger.debug(f"(Re)connect waiting for recv socket lock.")
-                    with self._recv_socket_lock:
-                        while (retries == 0 or tries < retries) and not self._connected_and_initialized:
+                # try to (re)connect until successful. the recv lock is taken
+                # first since the reader may need the send lock to reply to
+                # the server before it gets back to waiting on the selector
+                logger.debug(f"(Re)connect waiting for recv lock.")
+                with self._recv_lock:
+                    logger.debug(f"(Re)connect waiting for send lock.")
+                    with self._send_lock:
+                        self._drain_wakeup()
+                        while (retries == 0 or tries < retries) and not self._connected_and_initialized and not self._please_stop:
                             logger.info("Connecting to VNC server...")
                             try:
-                                # close existing sockets if this is a reconnect
-                                if self.send_socket is not None:
-                                    self.send_socket.close()
-                                if self.recv_socket is not None:
-                                    self.recv_socket.close()
-
-                                # create the first socket
-                                self.send_socket = socket.create_connection((self.hostname, self.port))
-
-                                # create the second socket using the first sockets file descriptor. this lets python use the same socket in 2 different threads without connecting an entirely separate socket
-                                self.recv_socket = socket.fromfd(self.send_socket.fileno(), self.send_socket.family, self.send_socket.type)
-
-                                # set a timeout on the recv_socket so it releases the lock periodically
-                                self.recv_socket.settimeout(self.recv_socket_timeout)
+                                # close the existing socket if this is a reconnect
+                                if self.socket is not None:
+                                    self._selector.unregister(self.socket)
+                                    self.socket.close()
+                                    self.socket = None
+                                self._recv_buffer.clear()
+
+                                self.socket = self._open_socket()
+                                self._selector.register(self.socket, selectors.EVENT_READ)
                                 logger.info("Connected to VNC Server.")
                                 logger.info("Initializing VNC connection...")
                                 self._protocol_handshake(needs_lock=False)
@@ -131,16 +232,20 @@ class SyncVNCClient(Thread):
                                 if retries != 0 and tries == retries:
                                     logger.error(f"Failed to connect after {retries} tries. Giving up.")
                                     raise
-                                logger.warning(f"Connection failed... retrying in {retry_sleep} seconds...")
+                                delay = max(retry_sleep, MIN_RETRY_SLEEP)
+                                logger.warning(f"Connection failed... retrying in {delay} seconds...")
                                 tries += 1
-                                if retry_sleep > 0:
-                                    time.sleep(retry_sleep)
+                                self._stopped.wait(delay)
+                        if not self._connected_and_initialized and self._please_stop:
+                            raise _RecvInterrupted()
             finally:
                 self._reconnecting = False
+        # there's a new framebuffer, and any outstanding update request was lost with the old connection
+        self._run_update_callbacks()
 
     def _protocol_handshake(self, needs_lock=True):
         logger.debug("Conducting protocol handshake")
-        self.vnc_server_version = self._full_recv(12, needs_lock=needs_lock)
+        self.vnc_server_version = self._full_recv(12)
         if self.vnc_server_version != b'RFB 003.008\x0a':
             raise NotImplementedError(f"Backwards compatibility with older protocol versions is not yet supported: {str(self.vnc_server_version)}")
         self._safe_send(b'RFB 003.008\x0a', needs_lock=needs_lock)
@@ -150,19 +255,24 @@ class SyncVNCClient(Thread):
     def _security_handshake(self, needs_lock=True):
         logger.debug("Conducting security handshake")
         # Get security types 
-        number_of_types = _unpack_single(U8, self._full_recv(1, needs_lock=needs_lock))
+        number_of_types = _unpack_single(U8, self._full_recv(1))
 
         # handle server aborting the connection
         if number_of_types == 0:
             self._get_failure_reason()
             
-        supported_security_types = self._full_recv(number_of_types, needs_lock=needs_lock)
+        supported_security_types = self._full_recv(number_of_types)
         supported_security_types = struct.unpack(f'{number_of_types}B', supported_security_types)
 
         # choose no security by default
         if 1 in supported_security_types:
             self._safe_send(struct.pack(U8, 1), needs_lock=needs_lock)
 
+            # RFB 3.8 sends a SecurityResult even for no security
+            handshake_result = _unpack_single(U32, self._full_recv(4))
+            if handshake_result:
+                self._get_failure_reason()
+
         # otherwise use VNC security
         elif 2 in supported_security_types:
             if self.password is None:
@@ -172,7 +282,7 @@ class SyncVNCClient(Thread):
             self._safe_send(struct.pack(U8, 2), needs_lock=needs_lock)
 
             # server sends a randomly generated challenge
-            challenge = self._full_recv(16, needs_lock=needs_lock)
+            challenge = self._full_recv(16)
 
             # encrypt the challenge with the password and send it back
             new_password = self._process_password(self.password)
@@ -181,18 +291,18 @@ class SyncVNCClient(Thread):
             self._safe_send(response, needs_lock=needs_lock)
 
             # Retrieve SecurityResult
-            handshake_result = _unpack_single(U32, self._full_recv(4, needs_lock=needs_lock))
+            handshake_result = _unpack_single(U32, self._full_recv(4))
             if handshake_result:
-                self._get_failure_reason(needs_lock=needs_lock)
+                self._get_failure_reason()
 
         else:
             raise VNCUnsupportedSecurityTypes("VNC Server does not allow any supported security types")
         logger.debug("Security handshake successful")
 
 
-    def _get_failure_reason(self, needs_lock=True):
-        reason_len = _unpack_single(U32, self._full_recv(4, needs_lock=needs_lock))
-        reason = self._full_recv(reason_len, needs_lock=needs_lock)
+    def _get_failure_reason(self):
+        reason_len = _unpack_single(U32, self._full_recv(4))
+        reason = self._full_recv(reason_len)
         reason = _unpack_single(STRING.format(reason_len), reason)
         raise ConnectionRefusedError(f"VNC Server refused connection with reason: {reason.decode('ASCII')}")
         
@@ -237,19 +347,22 @@ class SyncVNCClient(Thread):
         # ClientInit
         self._safe_send(struct.pack(BOOL, self.share), needs_lock=needs_lock)
         # Start receiving server init
-        framebuffer_width = struct.unpack(U16, self._full_recv(2, needs_lock=needs_lock))[0]
-        framebuffer_height = struct.unpack(U16, self._full_recv(2, needs_lock=needs_lock))[0]
-        pixel_format = struct.unpack(PIXEL_FORMAT, self._full_recv(16, needs_lock=needs_lock))
-        name_length = struct.unpack(U32, self._full_recv(4, needs_lock=needs_lock))[0]
+        framebuffer_width = struct.unpack(U16, self._full_recv(2))[0]
+        framebuffer_height = struct.unpack(U16, self._full_recv(2))[0]
+        pixel_format = struct.unpack(PIXEL_FORMAT, self._full_recv(16))
+        name_length = struct.unpack(U32, self._full_recv(4))[0]
         name_string = struct.unpack(STRING.format(name_length), 
-                                    self._full_recv(name_length, needs_lock=needs_lock))[0]
+                                    self._full_recv(name_length))[0]
         self.server_pixel_format = PixelFormat(*pixel_format)
         self.vnc_name = name_string
-        self._set_encodings([RAW_ENCODING, DESKTOP_SIZE_ENCODING], needs_lock=needs_lock)
+        self._server_clipboard_caps = None
+        self._server_clipboard_flags = 0
+        self.supports_set_desktop_size = False
+        self._set_encodings([RAW_ENCODING, EXTENDED_DESKTOP_SIZE_ENCODING, DESKTOP_SIZE_ENCODING, EXTENDED_CLIPBOARD_ENCODING], needs_lock=needs_lock)
         self._set_pixel_format(needs_lock=needs_lock)
 
         # re-init the framebuffer
-        self.framebuffer = Framebuffer(framebuffer_width, framebuffer_height, self.pixel_format.bits_per_pixel // 8)
+        self.framebuffer = Framebuffer(framebuffer_width, framebuffer_height, self.pixel_format.bits_per_pixel // 8, self.pixel_format)
         logger.debug("Initialization messages sent")
 
     def _set_pixel_format(self, pixel_format=None, needs_lock=True):
@@ -291,6 +404,8 @@ class SyncVNCClient(Thread):
         rectangles = []
         resize = False
         new_width, new_height = 0, 0
+        new_screens = None
+        desktop_size_status = None
 
         # collect the rectangles
         for _ in range(number_of_rectangles):
@@ -302,18 +417,39 @@ class SyncVNCClient(Thread):
             if encoding_type == DESKTOP_SIZE_ENCODING:
                 resize = True
                 new_width, new_height = width, height
+            elif encoding_type == EXTENDED_DESKTOP_SIZE_ENCODING:
+                # x is the reason for the change and y the status of a resize we asked for
+                screens = self._get_screens()
+                self.supports_set_desktop_size = True
+                if y == 0:
+                    resize = True
+                    new_width, new_height, new_screens = width, height, screens
+                if x == DESKTOP_SIZE_REASON_CLIENT:
+                    desktop_size_status = y
             else:
                 pixel_data = _collect_rectangle(width, height, encoding_type)
                 rectangles.append((x, y, width, height, pixel_data))
         if resize:
-            self.framebuffer.resize(new_width, new_height)
+            self.framebuffer.resize(new_width, new_height, new_screens)
         for rectangle in rectangles:
             self.framebuffer.set_pixels(*rectangle)
+        if desktop_size_status is not None:
+            # only wake request_desktop_size once the framebuffer has actually been resized
+            self._desktop_size_status = desktop_size_status
+            self._desktop_size_reply.set()
 
+        self._run_update_callbacks()
         # mark the framebuffer as updated in case a framebuffer update request is waiting
-        self._framebuffer_updated = True
+        self._framebuffer_updated.set()
                 
 
+    def _get_screens(self):
+        number_of_screens = _unpack_single(U8, self._full_recv(1))
+        self._full_recv(3)
+        screen_size = struct.calcsize(SCREEN)
+        data = self._full_recv(number_of_screens * screen_size)
+        return [Screen.unpack(data[i : i + screen_size]) for i in range(0, len(data), screen_size)]
+
     def _handle_set_color_map_entries(self):
         logger.info("Handling set color map entries")
         self._full_recv(1)
@@ -329,8 +465,49 @@ class SyncVNCClient(Thread):
 
     def _handle_server_cut_text(self):
         logger.info("Handling server cut text")
-        length = _unpack_single(U32, self._full_recv(4))
-        self._full_recv(length)
+        self._full_recv(3)
+        length = _unpack_single(S32, self._full_recv(4))
+        if length >= 0:
+            self._set_server_clipboard(self._full_recv(length).decode("latin-1"))
+        else:
+            # a negative length means an extended clipboard message
+            self._handle_extended_clipboard(self._full_recv(-length))
+
+    def _handle_extended_clipboard(self, payload):
+        flags = _unpack_single(clipboard.FLAGS, payload[:4])
+        body = payload[4:]
+        logger.debug(f"Extended clipboard message with flags {flags:#010x}")
+        if flags & clipboard.ACTION_CAPS:
+            self._server_clipboard_caps = clipboard.parse_caps(flags, body)
+            self._server_clipboard_flags = flags
+            self._send_reply(clipboard.pack_extended(CLIENT_CUT_TEXT, clipboard.pack_caps()))
+        elif flags & clipboard.ACTION_REQUEST:
+            # always answer, with an empty provide if there's no text to give
+            text = self._local_clipboard if flags & clipboard.FORMAT_TEXT else None
+            self._send_reply(clipboard.pack_extended(CLIENT_CUT_TEXT, clipboard.pack_provide(text)))
+        elif flags & clipboard.ACTION_PEEK:
+            formats = clipboard.FORMAT_TEXT if self._local_clipboard is not None else 0
+            self._send_reply(clipboard.pack_extended(CLIENT_CUT_TEXT, clipboard.pack_flags(clipboard.ACTION_NOTIFY, formats)))
+        elif flags & clipboard.ACTION_NOTIFY:
+            # the server's clipboard changed, ask for the text if there is any
+            if flags & clipboard.FORMAT_TEXT:
+                self._send_reply(clipboard.pack_extended(CLIENT_CUT_TEXT, clipboard.pack_flags(clipboard.ACTION_REQUEST)))
+        elif flags & clipboard.ACTION_PROVIDE:
+            text = clipboard.parse_provide(flags, body)
+            # a provide without text means the server's clipboard holds no
+            # text, still wake anyone waiting for an answer to their request
+            self._set_server_clipboard(text if text is not None else "")
+
+    def _set_server_clipboard(self, text):
+        with self._clipboard_condition:
+            self.clipboard = text
+            self._clipboard_serial += 1
+            self._clipboard_condition.notify_all()
+        for callback in list(self._clipboard_callbacks):
+            try:
+                callback(text)
+            except Exception:
+                logger.exception("Clipboard callback raised an exception")
 
     def _handle_server_message(self, message_type):
         #self.s.settimeout(None)
@@ -344,104 +521,151 @@ class SyncVNCClient(Thread):
         message_handler_callbacks[message_type]()
         #self.s.settimeout(self._socket_timeout)
 
-    def _request_framebuffer_update(self, x, y, width, height, incremental=1):
+    def _run_update_callbacks(self):
+        for callback in list(self._update_callbacks):
+            try:
+                callback(self.framebuffer)
+            except Exception:
+                logger.exception("Update callback raised an exception")
+
+    def _pack_framebuffer_update_request(self, x, y, width, height, incremental):
         message = struct.pack(U8, 3)
         message += struct.pack(U8, incremental)
         message += struct.pack(U16, x)
         message += struct.pack(U16, y)
         message += struct.pack(U16, width)
         message += struct.pack(U16, height)
-        self._safe_send(message)
-        self._framebuffer_updated = False # set framebuffer updated to false
-        while not self._framebuffer_updated: # block until the framebuffer is updated by the response handler thread
-            time.sleep(0.1)
-        self._framebuffer_updated = True
+        return message
 
-    def _safe_send(self, *args, needs_lock=True, **kwargs):
+    def _request_framebuffer_update(self, x, y, width, height, incremental=1):
+        self._framebuffer_updated.clear()
+        self._safe_send(self._pack_framebuffer_update_request(x, y, width, height, incremental))
+        self._framebuffer_updated.wait() # block until the framebuffer is updated by the response handler thread
+
+    def _flush_send_queue(self):
+        # whoever holds the send lock sends everything queued so far in one go,
+        # so messages from concurrent callers are coalesced and stay in order
+        batch = []
+        while self._send_queue:
+            batch.append(self._send_queue.popleft())
+        if not batch:
+            return
         try:
-            if self.send_socket is not None:
-                if needs_lock:
-                    logger.debug("Waiting for send socket lock.")
-                    with self._send_socket_lock:
-                        logger.debug("Send socket lock acquired.")
-                        self.send_socket.send(*args, **kwargs)
-                else:
-                    self.send_socket.send(*args, **kwargs)
-            logger.debug(f"Send {args[0]}")
-        except ConnectionError as e:
-            logger.warning(f"Send thread caught ConnectionError {e} - reconnecting")
-            logger.debug("Closing send socket")
-            self._connected_and_initialized = False
-            if self.send_socket is not None:
-                self.send_socket.close()
-            logger.debug("Closing recv socket")
-            if self.recv_socket is not None:
-                self.recv_socket.close()
-            logger.debug("Reconnecting")
-            self._connect()
-
-            logger.debug("Retry the send")
-            # try the send again
-            self._safe_send(*args, needs_lock=needs_lock, **kwargs)
+            self.socket.sendall(b''.join(batch))
+        except ConnectionError:
+            # put the batch back so it's sent again after reconnecting
+            self._send_queue.extendleft(reversed(batch))
+            raise
+        logger.debug(f"Sent {batch}")
+
+    def _safe_send(self, data, needs_lock=True):
+        if not needs_lock:
+            # the caller already holds the send lock (ie during the handshake)
+            self.socket.sendall(data)
+            logger.debug(f"Sent {data}")
+            return
+        self._send_queue.append(data)
+        recovered = False
+        while True:
+            failed_socket = self.socket
+            try:
+                with self._send_lock:
+                    self._flush_send_queue()
+                break
+            except ConnectionError as e:
+                logger.warning(f"Send thread caught ConnectionError {e} - reconnecting")
+                try:
+                    self._connect(failed_socket=failed_socket)
+                except _RecvInterrupted:
+                    raise ConnectionError("Client was stopped while reconnecting") from None
+                recovered = True
+        if recovered:
             logger.warning(f"Send successfully recovered.")
 
-    def _safe_recv(self, *args, retry_on_timeout=True, needs_lock=True, **kwargs):
-        do_while = True # emulate a do while loop
-        success = False # set to true after successful recv
-        d = b''
-        while do_while or (retry_on_timeout and not success and not self._please_stop):
-            do_while = False
-            try:
-                if self.recv_socket is not None:
-                    if needs_lock: 
-                        logger.debug("Acquiring recv socket lock...")
-                        if self._recv_socket_lock.acquire(blocking=False):
-                            try:
-                                logger.debug("Recv socket lock acquired.")
-                                d = self.recv_socket.recv(*args, **kwargs)
-                            finally:
-                                self._recv_socket_lock.release()
-                        else:
-                            logger.debug("Recv lock already held")
-                    else:
-                        d = self.recv_socket.recv(*args, **kwargs)
-                    success = True
-            except socket.timeout:
-                logger.debug("Recv timed out.")
-
-        logger.debug(f"Received data: {d}")
-        return d
-
-    def _full_recv(self, bufsize, *args, needs_lock=True, **kwargs):
-        buf = b''
-        n = 0
-        while n < bufsize and not self._please_stop:
-            buf += self._safe_recv(min(bufsize - n, CHUNK_SIZE), needs_lock=needs_lock, *args, **kwargs)
-            n = len(buf)
-        return buf
-
-    def _timeout_send(self, *args, **kwargs):
+    def _send_reply(self, data):
+        """
+        Sends from the reader thread. The reader holds the recv lock, so it
+        can't reconnect here; a dead connection is noticed on its next read
+        and the reply stays queued until then.
+        """
+        self._send_queue.append(data)
         try:
-            self._safe_send(*args, **kwargs)
-        except socket.timeout:
-            pass
+            with self._send_lock:
+                self._flush_send_queue()
+        except ConnectionError as e:
+            logger.warning(f"Receive thread caught ConnectionError {e} while replying")
 
-    def _timeout_recv(self, *args, **kwargs):
-        try:
-            return self._full_recv(*args, **kwargs)
-        except socket.timeout:
-            pass
-        return None
+    def _wait_readable(self):
+        """
+        Blocks until the socket has data. Raises _RecvInterrupted if the wakeup
+        socket fires first.
+        """
+        while True:
+            ready = [key.fileobj for key, _ in self._selector.select()]
+            if self._wakeup_recv in ready:
+                self._drain_wakeup()
+                raise _RecvInterrupted()
+            if ready:
+                return
+
+    def _recv_chunk(self, bufsize):
+        self._wait_readable()
+        data = self.socket.recv(bufsize)
+        if not data:
+            raise ConnectionResetError("VNC server closed the connection")
+        return data
+
+    def _full_recv(self, bufsize):
+        """
+        Returns exactly bufsize bytes from the socket. Small reads are served
+        from a read-ahead buffer so parsing headers doesn't cost a syscall per
+        field, large reads go straight into a preallocated buffer.
+        """
+        buffered = len(self._recv_buffer)
+        if buffered < bufsize:
+            if bufsize - buffered >= CHUNK_SIZE:
+                data = bytearray(bufsize)
+                data[:buffered] = self._recv_buffer
+                self._recv_buffer.clear()
+                view = memoryview(data)
+                n = buffered
+                while n < bufsize:
+                    self._wait_readable()
+                    received = self.socket.recv_into(view[n:])
+                    if received == 0:
+                        raise ConnectionResetError("VNC server closed the connection")
+                    n += received
+                return data
+            while len(self._recv_buffer) < bufsize:
+                self._recv_buffer += self._recv_chunk(CHUNK_SIZE)
+        data = bytes(self._recv_buffer[:bufsize])
+        del self._recv_buffer[:bufsize]
+        return data
 
     def _check_for_messages(self):
-        message = self._safe_recv(1, retry_on_timeout=False)
-        if message:
-            message_type = message
-            self._handle_server_message(message_type[0])
-        else:
-            message_type = None
+        message_type = self._full_recv(1)[0]
+        self._handle_server_message(message_type)
         return message_type
 
+    def request_framebuffer_update(self, x=0, y=0, width=None, height=None, incremental=True):
+        """
+        Sends a FramebufferUpdateRequest without waiting for the reply, the
+        whole framebuffer by default. Use add_update_callback to find out when
+        the update arrives.
+        """
+        if width is None:
+            width = self.framebuffer.width - x
+        if height is None:
+            height = self.framebuffer.height - y
+        self._safe_send(self._pack_framebuffer_update_request(x, y, width, height, int(incremental)))
+
+    def send_message(self, message):
+        """
+        Sends a raw client to server RFB message, ie to forward input from
+        another RFB client. It goes through the same queue as everything else.
+        """
+        self._safe_send(message)
+
     def refresh_resolution(self):
         """
         Requests an incremental framebuffer update with only 1 pixel. Hopefully
@@ -455,6 +679,32 @@ class SyncVNCClient(Thread):
         """
         self._request_framebuffer_update(0, 0, 1, 1, incremental=0)
 
+    def request_desktop_size(self, width, height, screens=None, timeout=10):
+        """
+        Asks the server to resize the desktop, ie to run a headless session at
+        a small resolution and save bandwidth. screens is a list of Screen for
+        multi-screen layouts; by default the current single screen is resized.
+        Needs a server that supports ExtendedDesktopSize, which is only known
+        after the first framebuffer update, and the receive thread running.
+
+        Raises VNCDesktopSizeError if the server refuses.
+        """
+        if not self.supports_set_desktop_size:
+            raise VNCDesktopSizeError("Server hasn't announced ExtendedDesktopSize support, request a framebuffer update first")
+        if screens is None:
+            current = self.framebuffer.screens
+            screen_id = current[0].id if len(current) == 1 else 0
+            screens = [Screen(screen_id, 0, 0, width, height, 0)]
+        message = struct.pack(SET_DESKTOP_SIZE, 251, width, height, len(screens))
+        message += b"".join(screen.pack() for screen in screens)
+        self._desktop_size_reply.clear()
+        self._safe_send(message)
+        if not self._desktop_size_reply.wait(timeout):
+            raise VNCDesktopSizeError(f"Server didn't answer the resize request within {timeout} seconds")
+        status = self._desktop_size_status
+        if status != 0:
+            raise VNCDesktopSizeError(f"Server refused to resize to {width}x{height}: {DESKTOP_SIZE_STATUS.get(status, status)}")
+
     def _key_to_keysym(self, key):
         # single character basic ascii text
         if len(key) == 1 and ord(key) > 0x1f and ord(key) < 0x7f:
@@ -550,8 +800,7 @@ class SyncVNCClient(Thread):
         event = struct.pack(POINTER_EVENT, 0x05, self.mouse_buttons, x, y)
         self._safe_send(event)
 
-    def screenshot(self, filename="screenshot.png", refresh=True, incremental=0, show=False, x=0, y=0, width=1, height=1):
-        
+    def _refresh_for_screenshot(self, x, y, width, height):
         # Always need to call with incremental = 0 to actually get a screenshot.
         # Seems to get a blank screen otherwise.
         self._request_framebuffer_update(x, y, width, height, incremental=0)
@@ -559,50 +808,143 @@ class SyncVNCClient(Thread):
         # If this is not the 1st screenshot, then use incremental=2.
         if not self.first_screenshot:
             self._request_framebuffer_update(x, y, 1447, 737, incremental=2)
-        
+        self.first_screenshot = False
+
+    def screenshot_async(self, filename=None, format=None, refresh=True, x=0, y=0, width=1, height=1, **options):
+        """
+        Takes a screenshot without waiting for it to be encoded. Only the
+        framebuffer copy happens on the calling thread, the encoding (and
+        writing to filename if given) happens on a worker thread.
+
+        format is one of png, jpeg, webp, ppm, npy or any other format Pillow
+        can save, and is guessed from filename if not given. Extra options such
+        as compress_level or quality are passed through to Pillow.
+
+        Returns a concurrent.futures.Future that resolves to the encoded bytes.
+        If the framebuffer hasn't changed since the last screenshot with the
+        same format and options, the previous encode is reused.
+        """
+        if refresh:
+            self._refresh_for_screenshot(x, y, width, height)
+        return self._screenshot_encoder.submit(self.framebuffer, filename=filename, format=format, **options)
 
-        # Flatten list
-        img = Image.frombytes("RGBX", (self.framebuffer.width, self.framebuffer.height), self.framebuffer.flatten())
-        rgb_image = img.convert("RGB")
+    def screenshot(self, filename="screenshot.png", refresh=True, incremental=0, show=False, x=0, y=0, width=1, height=1, **options):
         if show:
-            rgb_image.show()
+            if refresh:
+                self._refresh_for_screenshot(x, y, width, height)
+            pixel_bytes, fb_width, fb_height, _ = self.framebuffer.snapshot()
+            Image.frombytes("RGB", (fb_width, fb_height), pixel_bytes, "raw", "RGBX").show()
         else:
-            rgb_image.save(filename)
-        self.first_screenshot = False
-        
-        
-        
+            self.screenshot_async(filename, refresh=refresh, x=x, y=y, width=width, height=height, **options).result()
 
     def cut_buffer(self, buffer):
-        length = len(buffer)
-        message = struct.pack(U8, 6)
-        message += struct.pack('x') 
-        message += struct.pack('x') 
-        message += struct.pack('x') 
-        message += struct.pack(U32, length)
-        for b in buffer:
-            message += struct.pack(U8, ord(b))
-        self._safe_send(message)
+        """
+        Sends a legacy ClientCutText message. buffer is str (encoded as
+        Latin-1, raising UnicodeEncodeError if it can't be) or bytes.
+        """
+        self._safe_send(clipboard.pack_cut_text(CLIENT_CUT_TEXT, buffer))
+
+    def set_clipboard(self, text):
+        """
+        Sets the server's clipboard to text. If the server supports the
+        extended clipboard the text is sent as compressed UTF-8, otherwise it
+        falls back to a Latin-1 cut_buffer, which raises UnicodeEncodeError
+        for text it can't represent.
+        """
+        if self._server_clipboard_caps is None or clipboard.FORMAT_TEXT not in self._server_clipboard_caps:
+            self.cut_buffer(text)
+            return
+        self._local_clipboard = text
+        if self._server_clipboard_flags & clipboard.ACTION_NOTIFY:
+            # announce it and let the server request it when it's pasted. the
+            # size limit only applies to unsolicited provides
+            self._safe_send(clipboard.pack_extended(CLIENT_CUT_TEXT, clipboard.pack_flags(clipboard.ACTION_NOTIFY)))
+        elif self._server_clipboard_flags & clipboard.ACTION_PROVIDE:
+            max_size = self._server_clipboard_caps[clipboard.FORMAT_TEXT]
+            size = len(text.encode("utf-8")) + 1
+            if size > max_size:
+                raise ValueError(f"Clipboard text is {size} bytes but the server accepts at most {max_size}")
+            self._safe_send(clipboard.pack_extended(CLIENT_CUT_TEXT, clipboard.pack_provide(text)))
+        else:
+            self.cut_buffer(text)
+
+    def get_clipboard(self):
+        """
+        Returns the last clipboard text received from the server, or None.
+        """
+        return self.clipboard
+
+    def wait_for_clipboard(self, timeout=None, request=True):
+        """
+        Blocks until the server sends clipboard text and returns it, or None on
+        timeout. If the server supports extended clipboard requests and
+        request=True it's asked for its current clipboard instead of waiting
+        for it to change, and "" is returned if it holds no text.
+        """
+        with self._clipboard_condition:
+            serial = self._clipboard_serial
+        if request and self._can_request_clipboard():
+            self._safe_send(clipboard.pack_extended(CLIENT_CUT_TEXT, clipboard.pack_flags(clipboard.ACTION_REQUEST)))
+        with self._clipboard_condition:
+            if not self._clipboard_condition.wait_for(lambda: self._clipboard_serial != serial, timeout):
+                return None
+            return self.clipboard
+
+    def _can_request_clipboard(self):
+        return (self._server_clipboard_caps is not None
+                and clipboard.FORMAT_TEXT in self._server_clipboard_caps
+                and self._server_clipboard_flags & clipboard.ACTION_REQUEST)
+
+    def add_clipboard_callback(self, callback):
+        """
+        Calls callback(text) whenever the server sends clipboard text. Callbacks
+        run on the receive thread so they should return quickly.
+        """
+        self._clipboard_callbacks.append(callback)
+
+    def remove_clipboard_callback(self, callback):
+        self._clipboard_callbacks.remove(callback)
+
+    def add_update_callback(self, callback):
+        """
+        Calls callback(framebuffer) after every framebuffer update has been
+        applied, and after a reconnect replaces the framebuffer. Callbacks run
+        on the receive (or reconnecting) thread so they should return quickly
+        and not send anything themselves.
+        """
+        self._update_callbacks.append(callback)
+
+    def remove_update_callback(self, callback):
+        self._update_callbacks.remove(callback)
 
     def stop(self):
         self._please_stop = True
+        self._stopped.set()
+        self._wakeup() # the reader is blocked on the selector, not a timeout, so nudge it
         if self._running:
             self.join()
-            self.running = False
+            self._running = False
+        # let queued screenshots finish in the background
+        self._screenshot_encoder.shutdown(wait=False)
 
     def run(self):
         self._running = True
         while not self._please_stop:
+            if self._reconnecting:
+                # wait for the other thread's reconnect to finish before reading again
+                with self._reconnecting_lock:
+                    pass
+            failed_socket = self.socket
             try:
-                self._check_for_messages()
+                with self._recv_lock:
+                    self._check_for_messages()
+            except _RecvInterrupted:
+                pass
             except ConnectionError as e:
-                logger.warning(f"Receive thread caught ConnectionError {e} - waiting for reconnection")
-
-                # wait until the main thread tries to start reconnecting
-                while not self._reconnecting:
-                    time.sleep(0.5)
-
-                # wait until the reconnection is finished
-                with self._reconnecting_lock:
-                    self._reconnecting = False
-                logger.warning("Receive thread detected successful reconnection.")
+                logger.warning(f"Receive thread caught ConnectionError {e} - reconnecting")
+                try:
+                    self._connect(failed_socket=failed_socket)
+                except _RecvInterrupted:
+                    pass
+                else:
+                    logger.warning("Receive thread detected successful reconnection.")
@@ -0,0 +1,155 @@
+import io
+import logging
+import os
+import struct
+
+from concurrent.futures import Future, ThreadPoolExecutor
+from PIL import Image
+from threading import Lock
+
+logger = logging.getLogger(__name__)
+
+# file extension -> output format
+EXTENSIONS = {
+    ".png": "png",
+    ".jpg": "jpeg",
+    ".jpeg": "jpeg",
+    ".webp": "webp",
+    ".ppm": "ppm",
+    ".npy": "npy",
+}
+FORMATS = ("png", "jpeg", "webp", "ppm", "npy")
+
+# Pillow's default png compression level (6) takes hundreds of milliseconds on
+# a 1080p frame, level 1 is several times faster for a slightly bigger file
+DEFAULT_OPTIONS = {
+    "png": {"compress_level": 1},
+    "jpeg": {"quality": 90},
+    "webp": {"quality": 90},
+}
+
+NPY_MAGIC = b"\x93NUMPY\x01\x00"
+
+
+def _check_format(format):
+    """
+    Accepts the formats above plus anything else Pillow can save (bmp, tiff,
+    gif...) so the file always matches its extension.
+    """
+    if format in FORMATS:
+        return
+    Image.init()
+    if format.upper() not in Image.SAVE:
+        raise ValueError(f"Unsupported screenshot format: {format}")
+
+
+def _npy_header(width, height):
+    """
+    Builds a version 1.0 .npy header for a (height, width, 3) uint8 array so
+    raw frames can be written without depending on numpy.
+    """
+    header = f"{{'descr': '|u1', 'fortran_order': False, 'shape': ({height}, {width}, 3), }}"
+    # magic + header length + header + newline must be a multiple of 64 bytes
+    padding = -(len(NPY_MAGIC) + 2 + len(header) + 1) % 64
+    header = header + " " * padding + "\n"
+    return NPY_MAGIC + struct.pack("<H", len(header)) + header.encode("ASCII")
+
+
+def encode(pixel_bytes, width, height, format="png", **options):
+    """
+    Encodes RGBX pixel bytes to the given format and returns the encoded
+    bytes. Options are passed through to Pillow's Image.save.
+    """
+    _check_format(format)
+    # decode straight from RGBX to RGB instead of building an RGBX image and converting it
+    image = Image.frombytes("RGB", (width, height), pixel_bytes, "raw", "RGBX")
+    if format == "npy":
+        return _npy_header(width, height) + image.tobytes()
+    save_options = dict(DEFAULT_OPTIONS.get(format, {}))
+    save_options.update(options)
+    buf = io.BytesIO()
+    image.save(buf, format.upper(), **save_options)
+    return buf.getvalue()
+
+
+def format_for_filename(filename, default="png"):
+    """
+    Guesses the output format from a filename's extension, falling back to
+    whatever Pillow would pick. Raises ValueError for unknown extensions
+    rather than writing a file whose contents don't match its name.
+    """
+    if filename is None:
+        return default
+    extension = os.path.splitext(filename)[1].lower()
+    if extension in EXTENSIONS:
+        return EXTENSIONS[extension]
+    pillow_format = Image.registered_extensions().get(extension)
+    if pillow_format is None or pillow_format not in Image.SAVE:
+        raise ValueError(f"Can't tell which format to save {filename} in, pass format explicitly")
+    return pillow_format.lower()
+
+
+class ScreenshotEncoder(object):
+    """
+    Encodes framebuffer snapshots on a pool of worker threads. The caller only
+    pays for copying the framebuffer, and if the framebuffer hasn't changed
+    since the last screenshot in the same format the previous encode is
+    reused.
+    """
+
+    def __init__(self, max_workers=2):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="screenshot")
+        self._lock = Lock()
+        self._last = {} # (format, options) -> (framebuffer, framebuffer version, future of encoded bytes)
+
+    def submit(self, framebuffer, filename=None, format=None, **options):
+        """
+        Snapshots the framebuffer and queues it for encoding. Returns a future
+        that resolves to the encoded bytes once they've been written to
+        filename (if one was given).
+        """
+        if format is None:
+            format = format_for_filename(filename)
+        _check_format(format)
+        key = (format, tuple(sorted(options.items())))
+
+        with self._lock:
+            last_framebuffer, last_version, encoded = self._last.get(key, (None, None, None))
+            if last_framebuffer is not framebuffer or last_version != framebuffer.version:
+                pixel_bytes, width, height, version = framebuffer.snapshot()
+                encoded = self._executor.submit(encode, pixel_bytes, width, height, format, **options)
+                self._last[key] = (framebuffer, version, encoded)
+            else:
+                logger.debug(f"Framebuffer unchanged since version {last_version}, reusing encoded {format}")
+
+        if filename is None:
+            return encoded
+        return self._write_when_done(encoded, filename)
+
+    def _write_when_done(self, encoded, filename):
+        written = Future()
+
+        def _write():
+            try:
+                data = encoded.result()
+                with open(filename, "wb") as f:
+                    f.write(data)
+            except Exception as e:
+                written.set_exception(e)
+            else:
+                written.set_result(data)
+
+        def _schedule(_):
+            # add_done_callback runs this on the caller's thread if the encode
+            # is already done (ie reused), so hand the write to the pool
+            try:
+                self._executor.submit(_write)
+            except RuntimeError as e:
+                # the pool was shut down before the encode finished
+                written.set_exception(e)
+
+        encoded.add_done_callback(_schedule)
+        return written
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
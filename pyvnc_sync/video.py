@@ -0,0 +1,230 @@
+import logging
+import queue
+import time
+
+from fractions import Fraction
+from threading import Thread, Event
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+FORMATS = ("rgb24", "y4m")
+
+logger = logging.getLogger(__name__)
+
+_REPEAT = object() # queued instead of a frame when the framebuffer hasn't changed
+_STOP = object()
+
+
+def _rgbx_to_rgb(pixel_bytes, width, height):
+    """
+    Drops the padding byte from RGBX pixels with three strided copies.
+    """
+    rgb = bytearray(width * height * 3)
+    rgb[0::3] = pixel_bytes[0::4]
+    rgb[1::3] = pixel_bytes[1::4]
+    rgb[2::3] = pixel_bytes[2::4]
+    return rgb
+
+
+def _rgbx_to_yuv444(pixel_bytes, width, height):
+    """
+    Converts RGBX pixels to planar BT.601 limited range YUV 4:4:4.
+    """
+    pixels = np.frombuffer(pixel_bytes, dtype=np.uint8).reshape(height, width, 4)
+    r = pixels[..., 0].astype(np.int32)
+    g = pixels[..., 1].astype(np.int32)
+    b = pixels[..., 2].astype(np.int32)
+    planes = np.empty((3, height, width), dtype=np.uint8)
+    planes[0] = ((66 * r + 129 * g + 25 * b + 128) >> 8) + 16
+    planes[1] = ((-38 * r - 74 * g + 112 * b + 128) >> 8) + 128
+    planes[2] = ((112 * r - 94 * g - 18 * b + 128) >> 8) + 128
+    return planes
+
+
+def _fit(pixel_bytes, width, height, target_width, target_height, bytes_per_pixel=4):
+    """
+    Crops or pads (with black) a frame to the size the stream started with,
+    since neither raw video nor y4m can change size midway.
+    """
+    fitted = bytearray(target_width * target_height * bytes_per_pixel)
+    row_length = min(width, target_width) * bytes_per_pixel
+    for row in range(min(height, target_height)):
+        source = row * width * bytes_per_pixel
+        destination = row * target_width * bytes_per_pixel
+        fitted[destination : destination + row_length] = pixel_bytes[source : source + row_length]
+    return fitted
+
+
+class VideoExporter(object):
+    """
+    Records a SyncVNCClient's framebuffer as video at a fixed frame rate.
+
+    A pacing thread samples the framebuffer every 1/fps seconds and only
+    copies it if its version changed; otherwise the previous frame is
+    repeated (or skipped with duplicate_unchanged=False). Frames go through a
+    bounded queue to a writer thread, so a slow consumer drops frames rather
+    than holding up sampling or the client's receive thread.
+
+    The client only receives updates it asks for, so with
+    request_updates=True (the default) the pacing thread keeps one
+    incremental update request outstanding and sends the next one once it's
+    been answered. Turn it off if something else (ie a VNCProxy) is already
+    requesting updates.
+
+    output is a filename or a binary file-like object such as the stdin of
+    an ffmpeg subprocess. format is rgb24 (raw frames, ie for ffmpeg -f
+    rawvideo -pix_fmt rgb24) or y4m (YUV 4:4:4, needs numpy). Like
+    screenshots, this assumes the default RGBX pixel format.
+    """
+
+    def __init__(self, client, output, fps=10, format="y4m", queue_size=8, duplicate_unchanged=True, request_updates=True):
+        if format not in FORMATS:
+            raise ValueError(f"Unsupported video format: {format}")
+        if format == "y4m" and np is None:
+            raise ImportError("numpy is required to write y4m video")
+        self.client = client
+        self.fps = fps
+        self.format = format
+        self.duplicate_unchanged = duplicate_unchanged
+        self.request_updates = request_updates
+        self.frames_written = 0
+        self.frames_dropped = 0
+        self.frames_repeated = 0
+        self._output = output
+        self._owns_output = isinstance(output, str)
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._please_stop = Event()
+        self._size = None # frame size of the stream, fixed by the first frame
+        self._updates = 0 # upstream updates seen, only written by the client's receive thread
+        self._sampler = Thread(target=self._sample_loop, name="vnc-video-sampler", daemon=True)
+        self._writer = Thread(target=self._write_loop, name="vnc-video-writer", daemon=True)
+
+    def start(self):
+        if self._owns_output:
+            self._output = open(self._output, "wb")
+        self._writer.start()
+        self._sampler.start()
+
+    def stop(self):
+        """
+        Stops sampling, writes whatever is still queued and closes the output
+        if it was opened from a filename.
+        """
+        self._please_stop.set()
+        if self._sampler.is_alive():
+            self._sampler.join()
+        if self._writer.is_alive():
+            self._queue.put(_STOP)
+            self._writer.join()
+        if self._owns_output:
+            if not isinstance(self._output, str):
+                # only close it if start() actually opened it
+                self._output.close()
+        else:
+            self._output.flush()
+
+    def _offer(self, frame):
+        try:
+            self._queue.put_nowait(frame)
+            return True
+        except queue.Full:
+            self.frames_dropped += 1
+            logger.debug("Video writer is falling behind, dropping a frame")
+            return False
+
+    def _on_update(self, framebuffer):
+        self._updates += 1
+
+    def _request_update(self, requested):
+        """
+        Sends a new update request if the last one has been answered or the
+        client reconnected, and returns what the outstanding request was sent
+        for.
+        """
+        framebuffer = self.client.framebuffer
+        if requested == (framebuffer, self._updates):
+            return requested
+        # ask for everything the first time and after the client reconnects
+        incremental = requested is not None and requested[0] is framebuffer
+        requested = (framebuffer, self._updates)
+        try:
+            self.client.request_framebuffer_update(incremental=incremental)
+        except ConnectionError as e:
+            logger.warning(f"Couldn't request a framebuffer update: {e}")
+        return requested
+
+    def _sample_loop(self):
+        interval = 1 / self.fps
+        next_frame = time.monotonic()
+        last_framebuffer = None
+        last_version = None
+        requested = None
+        if self.request_updates:
+            self.client.add_update_callback(self._on_update)
+        try:
+            while not self._please_stop.wait(max(0, next_frame - time.monotonic())):
+                next_frame += interval
+                now = time.monotonic()
+                if next_frame < now:
+                    # we fell behind (ie the process was suspended), don't try to catch up
+                    next_frame = now + interval
+                if self.request_updates:
+                    requested = self._request_update(requested)
+                framebuffer = self.client.framebuffer
+                if framebuffer is last_framebuffer and framebuffer.version == last_version:
+                    if self.duplicate_unchanged:
+                        self._offer(_REPEAT)
+                    continue
+                pixel_bytes, width, height, version = framebuffer.snapshot()
+                if width == 0 or height == 0:
+                    continue
+                # if the frame is dropped, sample it again next time instead of repeating an older one
+                if self._offer((pixel_bytes, width, height)):
+                    last_framebuffer, last_version = framebuffer, version
+        finally:
+            if self.request_updates:
+                self.client.remove_update_callback(self._on_update)
+
+    def _write_loop(self):
+        frame = None
+        while True:
+            item = self._queue.get()
+            if item is _STOP:
+                return
+            if item is _REPEAT:
+                if frame is None:
+                    continue
+                self.frames_repeated += 1
+            else:
+                frame = self._convert(*item)
+            try:
+                self._write(frame)
+            except (BrokenPipeError, ValueError, OSError) as e:
+                logger.error(f"Video output closed, stopping the recording: {e}")
+                self._please_stop.set()
+                return
+            self.frames_written += 1
+
+    def _convert(self, pixel_bytes, width, height):
+        if self._size is None:
+            self._size = (width, height)
+            if self.format == "y4m":
+                rate = Fraction(self.fps).limit_denominator(1001)
+                self._output.write(f"YUV4MPEG2 W{width} H{height} F{rate.numerator}:{rate.denominator} Ip A1:1 C444\n".encode("ASCII"))
+        elif (width, height) != self._size:
+            logger.warning(f"Framebuffer resized to {width}x{height}, fitting it to the recording's {self._size[0]}x{self._size[1]}")
+            pixel_bytes = _fit(pixel_bytes, width, height, *self._size)
+            width, height = self._size
+        if self.format == "y4m":
+            return _rgbx_to_yuv444(pixel_bytes, width, height)
+        return _rgbx_to_rgb(pixel_bytes, width, height)
+
+    def _write(self, frame):
+        if self.format == "y4m":
+            self._output.write(b"FRAME\n")
+            self._output.write(memoryview(frame).cast("B"))
+        else:
+            self._output.write(frame)
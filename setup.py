@@ -9,6 +9,7 @@ setuptools.setup(
     description="Very simple synchronous VNC client",
     packages=setuptools.find_packages(),
     install_requires=["des", "pillow"],
+    extras_require={"numpy": ["numpy"]}, # needed for Framebuffer.get_region and friends
     classifiers=[
         "Programming Language :: Python :: 3",
     ],